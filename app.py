@@ -1,19 +1,30 @@
 import os
 import uuid
 import subprocess
-import requests
 import time
 import logging
 import threading
-import shutil
-import json
 import socket
+import hmac
+import mimetypes
+import asyncio
+from contextlib import asynccontextmanager
+from itertools import chain
 from typing import Optional, Dict, Any
 
+import httpx
+import orjson
 import redis
-from pythonjsonlogger.json import JsonFormatter
+import redis.asyncio as aioredis
+from redis.cluster import RedisCluster
+from redis.exceptions import RedisClusterException
+from pythonjsonlogger.orjson import OrjsonFormatter
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks, Header
+from fastapi import FastAPI, Depends, Form, HTTPException, Header, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
 
 # ==========================================================
 # CONFIG VALIDATION
@@ -22,6 +33,7 @@ from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTa
 INTERNAL_SERVICE_KEY = os.getenv("INTERNAL_SERVICE_KEY")
 LMS_STORE_URL = os.getenv("LMS_STORE_URL")
 REDIS_URL = os.getenv("REDIS_URL")
+REDIS_CLUSTER = os.getenv("REDIS_CLUSTER", "false").lower() == "true"
 
 if not INTERNAL_SERVICE_KEY:
     raise RuntimeError("INTERNAL_SERVICE_KEY must be set")
@@ -40,7 +52,8 @@ logger.setLevel(LOG_LEVEL)
 
 handler = logging.StreamHandler()
 
-formatter = JsonFormatter(
+# orjson-backed so each record is serialized once, in C
+formatter = OrjsonFormatter(
     "%(asctime)s %(levelname)s %(name)s %(message)s"
 )
 
@@ -65,31 +78,120 @@ def log_event(event: str, level: str = "info", **kwargs):
 # APP INIT
 # ==========================================================
 
-app = FastAPI()
+HOSTNAME = socket.gethostname()  # fixed for the life of the process
 
 VIDEO_DIR = "temp_videos"
 os.makedirs(VIDEO_DIR, exist_ok=True)
 
 MAX_VIDEO_SIZE_MB = 500
-ALLOWED_VIDEO_EXTENSIONS = {".mp4", ".mov", ".mkv", ".avi"}
+MAX_VIDEO_SIZE_BYTES = MAX_VIDEO_SIZE_MB * 1024 * 1024
+MAX_FORM_FIELD_BYTES = 64 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+MAX_FORM_OVERHEAD_BYTES = 256 * 1024
+ALLOWED_VIDEO_EXTENSIONS = frozenset({".mp4", ".mov", ".mkv", ".avi"})
 REDIS_TTL = 7200  # 2 hours
+MAX_STATUS_WAIT_SECONDS = 60
+ORPHAN_SWEEP_INTERVAL = int(os.getenv("ORPHAN_SWEEP_INTERVAL", 300))  # seconds
+DEFAULT_X264_PRESET = "veryfast"
+ALLOWED_X264_PRESETS = {"ultrafast", "veryfast", "fast", "medium"}
+PASSTHROUGH_MAX_BITRATE = 1_500_000  # bits/s; at or below this 720p H.264 is copied as-is
+ENCODE_THREADS = max(1, int(os.getenv("ENCODE_THREADS", os.cpu_count() or 1)))
+# Encodes that may run at once, each using ENCODE_THREADS cores
+FFMPEG_CONCURRENCY = max(1, int(os.getenv(
+    "FFMPEG_CONCURRENCY",
+    (os.cpu_count() or 1) // ENCODE_THREADS
+)))
+# Jobs in flight; twice the encode slots so LMS uploads overlap encodes
+MAX_CONCURRENT_JOBS = max(1, int(os.getenv("MAX_CONCURRENT_JOBS", 2 * FFMPEG_CONCURRENCY)))
 
 
 # ==========================================================
 # JOB MANAGER
 # ==========================================================
 
+# Jobs are Redis hashes, so updates touch only the changed fields with no
+# JSON decode/encode. Sets the field/value pairs in ARGV[3..], refreshes the
+# TTL (ARGV[1]) and publishes the new status (ARGV[2]) on KEYS[2] for
+# /video/status/{id}/wait. A missing job is left alone, matching the
+# in-memory behaviour, rather than being recreated as a partial hash.
+UPDATE_JOB_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('PUBLISH', KEYS[2], ARGV[2])
+return 1
+"""
+
+# Compare-and-set on the status: moves the job from ARGV[1] to ARGV[2] only
+# if it is currently in ARGV[1]. Returns the job (HGETALL) as it was before
+# the call, or nil if missing, so the caller can tell whether it won.
+TRANSITION_JOB_SCRIPT = """
+local job = redis.call('HGETALL', KEYS[1])
+if #job == 0 then
+    return false
+end
+if redis.call('HGET', KEYS[1], 'status') == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'status', ARGV[2])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('PUBLISH', KEYS[2], ARGV[2])
+end
+return job
+"""
+
+
+def job_key(video_id: str) -> str:
+    # Hashtag braces: only the id is hashed, so all of a job's keys share a
+    # cluster slot and single-key scripts/pipelines stay on one shard.
+    return f"job:{{{video_id}}}"
+
+
+def decode_job(raw: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    # Hash fields come back as strings; restore the non-string ones
+    if not raw:
+        return None
+    job = dict(raw)
+    if "created_at" in job:
+        job["created_at"] = float(job["created_at"])
+    return job
+
+
+def job_events_channel(video_id: str) -> str:
+    return f"{job_key(video_id)}:events"
+
+
+def _resolve_waiter(waiter: asyncio.Future, status: str):
+    if not waiter.done():
+        waiter.set_result(status)
+
+
 class JobManager:
-    def __init__(self, redis_url: Optional[str]):
+    def __init__(self, redis_url: Optional[str], cluster: bool = False):
         self.use_redis = bool(redis_url)
+        self.cluster = cluster
         self.redis_client = None
         self.memory_store = {}
         self.memory_lock = threading.Lock()
+        self.memory_waiters: Dict[str, set] = {}
 
         if self.use_redis:
             try:
-                self.redis_client = redis.from_url(redis_url, decode_responses=True)
+                if cluster:
+                    self.redis_client = RedisCluster.from_url(redis_url, decode_responses=True)
+                else:
+                    self.redis_client = redis.from_url(redis_url, decode_responses=True)
                 self.redis_client.ping()
+                self._update_script = self.redis_client.register_script(UPDATE_JOB_SCRIPT)
+                self._transition_script = self.redis_client.register_script(TRANSITION_JOB_SCRIPT)
+                # Pub/sub is broadcast cluster-wide, so a plain async client
+                # pointed at any node can subscribe in cluster mode too.
+                self.async_redis_client = aioredis.from_url(redis_url, decode_responses=True)
+                # Job reads do have to reach the key's shard
+                self.async_jobs_client = (
+                    aioredis.RedisCluster.from_url(redis_url, decode_responses=True)
+                    if cluster else self.async_redis_client
+                )
                 log_event("redis_connected")
             except Exception as e:
                 raise RuntimeError(f"Redis connection failed: {e}")
@@ -98,107 +200,663 @@ class JobManager:
 
     def set_job(self, video_id: str, data: Dict[str, Any]):
         if self.use_redis:
-            self.redis_client.setex(
-                f"job:{video_id}",
-                REDIS_TTL,
-                json.dumps(data)
-            )
+            key = job_key(video_id)
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.delete(key)  # replace, don't merge with a previous record
+            pipe.hset(key, mapping=data)
+            pipe.expire(key, REDIS_TTL)
+            pipe.execute()
         else:
             with self.memory_lock:
                 self.memory_store[video_id] = data
 
     def get_job(self, video_id: str) -> Optional[Dict[str, Any]]:
         if self.use_redis:
-            raw = self.redis_client.get(f"job:{video_id}")
-            return json.loads(raw) if raw else None
+            return decode_job(self.redis_client.hgetall(job_key(video_id)))
+        else:
+            with self.memory_lock:
+                return self.memory_store.get(video_id)
+
+    async def get_job_async(self, video_id: str) -> Optional[Dict[str, Any]]:
+        # For coroutines: don't block the event loop on a Redis round trip
+        if self.use_redis:
+            return decode_job(await self.async_jobs_client.hgetall(job_key(video_id)))
         else:
             with self.memory_lock:
                 return self.memory_store.get(video_id)
 
     def update_status(self, video_id: str, status: str, extra: Dict[str, Any] = None):
-        job = self.get_job(video_id)
+        fields = {"status": status, **(extra or {})}
+
+        if self.use_redis:
+            # Merge server-side: one round trip and no read-modify-write race
+            self._update_script(
+                keys=[job_key(video_id), job_events_channel(video_id)],
+                args=[REDIS_TTL, status, *chain.from_iterable(fields.items())]
+            )
+        else:
+            with self.memory_lock:
+                self._merge_in_memory(video_id, fields)
+
+    def transition_status(self, video_id: str, expected: str, status: str) -> Optional[Dict[str, Any]]:
+        """
+        Atomically move a job from `expected` to `status`. Returns the job as
+        it was before the call; the transition happened iff its status was
+        `expected`.
+        """
+        if self.use_redis:
+            raw = self._transition_script(
+                keys=[job_key(video_id), job_events_channel(video_id)],
+                args=[expected, status, REDIS_TTL]
+            )
+            return decode_job(dict(zip(raw[::2], raw[1::2]))) if raw else None
+        else:
+            with self.memory_lock:
+                job = self.memory_store.get(video_id)
+                if job and job["status"] == expected:
+                    self._merge_in_memory(video_id, {"status": status})
+                return job
+
+    def update_statuses_bulk(self, statuses: Dict[str, str]):
+        if self.use_redis and self.cluster:
+            # redis-py blocks EVALSHA on cluster pipelines, so run the script
+            # per job; one failing shard shouldn't leave the rest unmarked
+            for video_id, status in statuses.items():
+                try:
+                    self.update_status(video_id, status)
+                except (redis.RedisError, RedisClusterException) as e:
+                    log_event("status_update_failed", level="error", video_id=video_id, error=str(e))
+        elif self.use_redis:
+            # One round trip for the whole batch instead of one per job
+            pipe = self.redis_client.pipeline(transaction=False)
+            for video_id, status in statuses.items():
+                self._update_script(
+                    keys=[job_key(video_id), job_events_channel(video_id)],
+                    args=[REDIS_TTL, status, "status", status],
+                    client=pipe
+                )
+            pipe.execute()
+        else:
+            with self.memory_lock:
+                for video_id, status in statuses.items():
+                    self._merge_in_memory(video_id, {"status": status})
+
+    def _merge_in_memory(self, video_id: str, fields: Dict[str, Any]):
+        # Caller holds memory_lock
+        job = self.memory_store.get(video_id)
         if not job:
             return
 
-        job["status"] = status
-        if extra:
-            job.update(extra)
+        self.memory_store[video_id] = {**job, **fields}
+        for waiter in self.memory_waiters.pop(video_id, ()):
+            waiter.get_loop().call_soon_threadsafe(_resolve_waiter, waiter, fields["status"])
+
+    async def wait_for_status_change(self, video_id: str, since: str, timeout: float) -> Optional[str]:
+        """Block until the job's status differs from `since` or `timeout` expires."""
+        if self.use_redis:
+            pubsub = self.async_redis_client.pubsub()
+            await pubsub.subscribe(job_events_channel(video_id))
+            try:
+                # Re-read after subscribing so a change in between isn't lost
+                job = await self.get_job_async(video_id)
+                if not job or job["status"] != since:
+                    return job["status"] if job else None
+
+                deadline = time.monotonic() + timeout
+                while (remaining := deadline - time.monotonic()) > 0:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+                    if message and message["data"] != since:
+                        return message["data"]
+                return since
+            finally:
+                await pubsub.unsubscribe()
+                await pubsub.aclose()
+
+        waiter = asyncio.get_running_loop().create_future()
+        with self.memory_lock:
+            job = self.memory_store.get(video_id)
+            if not job or job["status"] != since:
+                return job["status"] if job else None
+            self.memory_waiters.setdefault(video_id, set()).add(waiter)
 
-        self.set_job(video_id, job)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return since
+        finally:
+            with self.memory_lock:
+                waiters = self.memory_waiters.get(video_id)
+                if waiters:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self.memory_waiters[video_id]
 
     def delete_job(self, video_id: str):
         if self.use_redis:
-            self.redis_client.delete(f"job:{video_id}")
+            self.redis_client.delete(job_key(video_id))
         else:
             with self.memory_lock:
                 self.memory_store.pop(video_id, None)
 
+    async def aclose(self):
+        if self.use_redis:
+            if self.async_jobs_client is not self.async_redis_client:
+                await self.async_jobs_client.aclose()
+            await self.async_redis_client.aclose()
 
-job_manager = JobManager(REDIS_URL)
+
+job_manager = JobManager(REDIS_URL, cluster=REDIS_CLUSTER)
 
 
 # ==========================================================
 # FILE CLEANUP SAFETY (Prevents File Leaks)
 # ==========================================================
 
+def _unlink_silent(path: str):
+    # One unlink syscall instead of exists() + remove()
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
 def cleanup_orphan_files():
     now = time.time()
     expiration = 2 * 60 * 60  # 2 hours
 
-    for filename in os.listdir(VIDEO_DIR):
-        path = os.path.join(VIDEO_DIR, filename)
-        if os.path.isfile(path):
-            if now - os.path.getmtime(path) > expiration:
+    # scandir's DirEntry carries d_type from getdents, so only the mtime
+    # check costs a stat per file
+    with os.scandir(VIDEO_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            if now - entry.stat(follow_symlinks=False).st_mtime > expiration:
                 try:
-                    os.remove(path)
-                    log_event("orphan_file_deleted", file=filename)
+                    os.remove(entry.path)
+                    log_event("orphan_file_deleted", file=entry.name)
                 except Exception:
                     pass
 
 
+async def periodic_orphan_cleanup():
+    while True:
+        await asyncio.sleep(ORPHAN_SWEEP_INTERVAL)
+        try:
+            await run_in_threadpool(cleanup_orphan_files)
+        except Exception as e:
+            log_event("orphan_cleanup_failed", level="error", error=str(e))
+
+
+
+# ==========================================================
+# UPLOAD PERSISTENCE
+# ==========================================================
+
+class StreamingVideoForm:
+    """
+    Incremental multipart/form-data parser for /video/receive.
+
+    The `file` part is written straight to VIDEO_DIR as body chunks arrive,
+    so there is no spooled temp file to copy afterwards; the small text
+    fields are kept in `fields`.
+    """
+
+    def __init__(self, boundary: bytes):
+        self.fields: Dict[str, str] = {}
+        self.ext: Optional[str] = None
+        self.uid: Optional[str] = None
+        self.input_path: Optional[str] = None
+        self.received = 0
+
+        self._output = None
+        self._headers: Dict[bytes, bytes] = {}
+        self._header_field = bytearray()
+        self._header_value = bytearray()
+        self._part_name: Optional[str] = None
+        self._part_is_file = False
+        self._part_value = bytearray()
+        self._form_bytes = 0
+        self._complete = False
+
+        self._parser = MultipartParser(boundary, callbacks={
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_end": self._on_end,
+        })
+
+    def write(self, chunk: bytes):
+        self._parser.write(chunk)
+
+    def finalize(self):
+        self._parser.finalize()
+        self.close()
+        # finalize() doesn't check for the closing boundary; without it the
+        # body was cut off and the file part may be truncated.
+        if not self._complete:
+            raise MultipartParseError("Missing closing boundary")
+
+    def close(self):
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+
+    def discard(self):
+        self.close()
+        if self.input_path:
+            _unlink_silent(self.input_path)
+
+    # -- parser callbacks --------------------------------------------------
+
+    def _on_part_begin(self):
+        self._headers = {}
+        self._part_name = None
+        self._part_is_file = False
+        self._part_value = bytearray()
+
+    def _count_form_bytes(self, n: int):
+        # Without a Content-Length nothing else bounds the number of parts,
+        # so cap everything that isn't file data
+        self._form_bytes += n
+        if self._form_bytes > MAX_FORM_OVERHEAD_BYTES:
+            raise HTTPException(status_code=400, detail="Form fields too large")
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._count_form_bytes(end - start)
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._count_form_bytes(end - start)
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[bytes(self._header_field).lower()] = bytes(self._header_value)
+        self._header_field = bytearray()
+        self._header_value = bytearray()
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._part_name = options.get(b"name", b"").decode("utf-8", errors="replace")
+
+        if b"filename" not in options:
+            return
+
+        if self._part_name != "file" or self.input_path is not None:
+            raise HTTPException(status_code=400, detail="Unexpected file field")
+
+        filename = options[b"filename"].decode("utf-8", errors="replace")
+        ext = os.path.splitext(filename)[1].lower()
+        if ext not in ALLOWED_VIDEO_EXTENSIONS:
+            raise HTTPException(status_code=400, detail="Unsupported format")
+
+        self.ext = ext
+        self.uid = uuid.uuid4().hex
+        self.input_path = f"{VIDEO_DIR}/{self.uid}_raw{ext}"
+        # Match the 1 MiB body batches so the kernel sees 1 MiB writes rather
+        # than io.DEFAULT_BUFFER_SIZE pieces of each parser callback
+        self._output = open(self.input_path, "wb", buffering=UPLOAD_CHUNK_SIZE)
+        self._part_is_file = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._part_is_file:
+            self.received += end - start
+            if self.received > MAX_VIDEO_SIZE_BYTES:
+                raise HTTPException(status_code=413, detail="File too large")
+            self._output.write(data[start:end])
+        else:
+            self._count_form_bytes(end - start)
+            self._part_value += data[start:end]
+            if len(self._part_value) > MAX_FORM_FIELD_BYTES:
+                raise HTTPException(status_code=400, detail="Form field too large")
+
+    def _on_part_end(self):
+        if self._part_is_file:
+            self.close()
+        elif self._part_name:
+            self.fields[self._part_name] = self._part_value.decode("utf-8", errors="replace")
+
+    def _on_end(self):
+        self._complete = True
+
+
+# ==========================================================
+# HARDWARE ENCODER DETECTION
+# ==========================================================
+
+# Checked in order; the first encoder that can actually open a session wins.
+HW_ENCODER_CANDIDATES = {
+    "h264": ("h264_nvenc", "h264_amf", "h264_qsv", "h264_vaapi"),
+    "h265": ("hevc_nvenc", "hevc_amf", "hevc_qsv", "hevc_vaapi"),
+}
+SOFTWARE_ENCODERS = {"h264": "libx264", "h265": "libx265"}
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128")
+
+
+def list_ffmpeg_encoders() -> str:
+    try:
+        return subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        log_event("encoder_probe_failed", level="error", error=str(e))
+        return ""
+
+
+def detect_hw_encoder(listing: str, candidates) -> Optional[str]:
+    for encoder in candidates:
+        if encoder not in listing:
+            continue
+
+        # Distro builds list NVENC/AMF/QSV/VAAPI even without the hardware,
+        # so confirm with a one-frame test encode.
+        if encoder.endswith("_vaapi"):
+            # VAAPI encoders only take frames already uploaded to the device
+            source = ["-vaapi_device", VAAPI_DEVICE]
+            upload = ["-vf", "format=nv12,hwupload"]
+        else:
+            source, upload = [], []
+
+        probe = subprocess.run(
+            [
+                "ffmpeg", "-hide_banner", "-v", "error",
+                *source,
+                "-f", "lavfi", "-i", "color=black:s=256x256:d=0.1",
+                *upload,
+                "-frames:v", "1",
+                "-c:v", encoder,
+                "-f", "null", "-"
+            ],
+            capture_output=True
+        )
+        if probe.returncode == 0:
+            return encoder
+
+    return None
+
+
+_encoder_listing = list_ffmpeg_encoders()
+HW_ENCODERS = {
+    codec: detect_hw_encoder(_encoder_listing, candidates)
+    for codec, candidates in HW_ENCODER_CANDIDATES.items()
+}
+log_event("video_encoders_selected", **{
+    codec: HW_ENCODERS[codec] or SOFTWARE_ENCODERS[codec]
+    for codec in SOFTWARE_ENCODERS
+})
+
+
 # ==========================================================
 # COMPRESSION
 # ==========================================================
 
-def compress_video_ffmpeg(input_path, output_path):
-    command = [
-        "ffmpeg",
-        "-y",
-        "-i", input_path,
-        "-vf", "scale=-2:'min(720,ih)'",  # Prevent upscaling
-        "-c:v", "libx264",
-        "-crf", "30",
-        "-preset", "fast",
+def build_ffmpeg_command(input_path, output_path, encoder: str, preset: str = DEFAULT_X264_PRESET):
+    command = ["ffmpeg", "-y"]
+
+    if encoder.endswith("_nvenc"):
+        # Decode, scale and encode on the GPU without copying frames back.
+        # Constant quality (-cq 28, no bitrate target) like the other
+        # encoders, rather than a fixed 1.5M VBR that over- or under-shoots
+        # depending on the source.
+        command += [
+            "-hwaccel", "cuda",
+            "-hwaccel_output_format", "cuda",
+            "-i", input_path,
+            "-vf", "scale_cuda=-2:'min(720,ih)'",  # Prevent upscaling
+            "-c:v", encoder,
+            "-preset", "p4",
+            "-rc", "vbr",
+            "-cq", "28",
+            "-b:v", "0",
+        ]
+    elif encoder.endswith("_vaapi"):
+        # Decode, scale and encode on the VAAPI device (Intel/AMD iGPU)
+        command += [
+            "-hwaccel", "vaapi",
+            "-hwaccel_output_format", "vaapi",
+            "-vaapi_device", VAAPI_DEVICE,
+            "-i", input_path,
+            "-vf", "scale_vaapi=w=-2:h='min(720,ih)'",  # Prevent upscaling
+            "-c:v", encoder,
+            "-rc_mode", "CQP",
+            "-qp", "28",
+        ]
+    elif encoder.endswith("_amf"):
+        command += [
+            "-i", input_path,
+            "-vf", "scale=-2:'min(720,ih)'",  # Prevent upscaling
+            "-c:v", encoder,
+            "-usage", "transcoding",
+            "-quality", "speed",
+            "-rc", "cqp",
+            "-qp_i", "24",
+            "-qp_p", "26",
+        ]
+    elif encoder.endswith("_qsv"):
+        # ICQ 28 rather than 23, to stay in line with NVENC/VAAPI/x264 sizes
+        command += [
+            "-i", input_path,
+            "-vf", "scale=-2:'min(720,ih)'",  # Prevent upscaling
+            "-c:v", encoder,
+            "-preset", "faster",
+            "-global_quality", "28",
+        ]
+    elif encoder == "libx265":
+        command += [
+            "-i", input_path,
+            "-vf", "scale=-2:'min(720,ih)'",  # Prevent upscaling
+            "-c:v", "libx265",
+            "-crf", "28",
+            "-preset", preset,
+            "-pix_fmt", "yuv420p",
+            "-threads", str(ENCODE_THREADS),
+            "-x265-params", f"pools={ENCODE_THREADS}:log-level=error",
+        ]
+    else:
+        command += [
+            "-i", input_path,
+            "-vf", "scale=-2:'min(720,ih)'",  # Prevent upscaling
+            "-c:v", "libx264",
+            "-crf", "30",
+            "-preset", preset,
+            "-pix_fmt", "yuv420p",
+            "-threads", str(ENCODE_THREADS),
+            "-x264-params", (
+                f"threads={ENCODE_THREADS}:sliced-threads=0:"
+                f"lookahead-threads={max(1, ENCODE_THREADS // 4)}"
+            ),
+        ]
+
+    if encoder.startswith("hevc_") or encoder == "libx265":
+        if os.path.splitext(output_path)[1].lower() in (".mp4", ".mov"):
+            # Apple players only accept HEVC in MP4/MOV under the hvc1 tag
+            command += ["-tag:v", "hvc1"]
+
+    command += [
         "-c:a", "aac",
         "-b:a", "128k",
         "-movflags", "+faststart",
         output_path
     ]
-    subprocess.run(command, check=True)
+    return command
+
+
+async def run_ffmpeg(command):
+    proc = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+
+    if proc.returncode != 0:
+        log_event(
+            "ffmpeg_failed",
+            level="error",
+            returncode=proc.returncode,
+            stderr=stderr.decode(errors="replace")[-2000:]
+        )
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
+async def probe_video(path) -> Optional[Dict[str, Any]]:
+    # Best effort: the passthrough check is only an optimisation, so any
+    # probe failure (ffprobe missing, bad output) means "just encode"
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error",
+            "-select_streams", "v:0",
+            "-show_entries", "stream=codec_name,height,bit_rate,pix_fmt",
+            "-of", "json",
+            path,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await proc.communicate()
+    except OSError as e:
+        log_event("ffprobe_failed", level="error", error=str(e))
+        return None
+
+    if proc.returncode != 0:
+        return None
+
+    try:
+        streams = orjson.loads(stdout).get("streams") or []
+    except (orjson.JSONDecodeError, AttributeError):
+        return None
+    return streams[0] if streams else None
+
+
+def is_already_compressed(info: Optional[Dict[str, Any]]) -> bool:
+    if not info:
+        return False
+
+    try:
+        height = int(info.get("height", 0))
+        bit_rate = int(info.get("bit_rate", 0))
+    except (TypeError, ValueError):
+        # e.g. bit_rate "N/A" for Matroska streams; just re-encode
+        return False
+
+    # yuv420p only, like the encode paths: 10-bit or 4:4:4 H.264 won't play
+    # on many decoders
+    return (
+        info.get("codec_name") == "h264"
+        and info.get("pix_fmt") == "yuv420p"
+        and 0 < height <= 720
+        and 0 < bit_rate <= PASSTHROUGH_MAX_BITRATE
+    )
+
+
+async def compress_video_ffmpeg(input_path, output_path, preset: str = DEFAULT_X264_PRESET, codec: str = "h264"):
+    if codec == "h264":
+        info = await probe_video(input_path)
+        if is_already_compressed(info):
+            # Already small H.264: remux only, no decode/encode
+            log_event("compression_passthrough", input=input_path, **info)
+            try:
+                await run_ffmpeg([
+                    "ffmpeg", "-y",
+                    "-i", input_path,
+                    "-c", "copy",
+                    "-movflags", "+faststart",
+                    output_path
+                ])
+                return
+            except subprocess.CalledProcessError as e:
+                # e.g. an audio codec the output container can't hold
+                log_event("passthrough_failed", level="error", error=str(e))
+
+    # `preset` only applies to the software encoders; hardware ones use their own.
+    hw_encoder = HW_ENCODERS[codec]
+    if hw_encoder:
+        try:
+            await run_ffmpeg(build_ffmpeg_command(input_path, output_path, hw_encoder))
+            return
+        except subprocess.CalledProcessError as e:
+            # e.g. a source codec the GPU decoder can't handle
+            log_event("hw_encode_failed", level="error", encoder=hw_encoder, error=str(e))
+
+    await run_ffmpeg(build_ffmpeg_command(input_path, output_path, SOFTWARE_ENCODERS[codec], preset))
 
 
 # ==========================================================
 # LMS CALLBACK
 # ==========================================================
 
-def send_to_lms(video_id, organization_id, compressed_path):
+# One pooled HTTP/2 client for all callbacks so TLS sessions and sockets
+# to the LMS are reused across jobs. Transport retries only cover failed
+# connects; non-200 responses are retried with backoff in send_to_lms.
+lms_client = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_keepalive_connections=16)
+    ),
+    timeout=30
+)
+
+
+def lms_multipart_envelope(video_id, organization_id, compressed_path):
+    # httpx's multipart encoder reads files synchronously on the event loop,
+    # so the body is framed here and only the file bytes are streamed.
+    boundary = uuid.uuid4().hex
+    filename = os.path.basename(compressed_path)
+    file_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    head = "".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        for name, value in (("video_id", video_id), ("organization_id", organization_id))
+    )
+    head += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: {file_type}\r\n\r\n"
+    )
+    tail = f"\r\n--{boundary}--\r\n"
+    return f"multipart/form-data; boundary={boundary}", head.encode(), tail.encode()
+
+
+async def iter_lms_body(head: bytes, f, tail: bytes):
+    yield head
+    # Disk reads happen in the threadpool, 1 MiB at a time
+    while chunk := await run_in_threadpool(f.read, UPLOAD_CHUNK_SIZE):
+        yield chunk
+    yield tail
+
+
+async def send_to_lms(video_id, organization_id, compressed_path):
+    # The compressed output is deliberately kept on disk rather than piped
+    # from ffmpeg: each retry re-reads it from the start, +faststart needs a
+    # seekable output, and the file is only released at /video/confirm.
     retries = 3
     backoff = 1
 
     for attempt in range(1, retries + 1):
         try:
-            with open(compressed_path, "rb") as f:
-                files = {"file": f}
-                data = {
-                    "video_id": video_id,
-                    "organization_id": organization_id
-                }
-                response = requests.post(
+            content_type, head, tail = lms_multipart_envelope(video_id, organization_id, compressed_path)
+            f = await run_in_threadpool(open, compressed_path, "rb")
+            try:
+                # An explicit length keeps the upload out of chunked encoding
+                length = len(head) + os.fstat(f.fileno()).st_size + len(tail)
+                response = await lms_client.post(
                     LMS_STORE_URL,
-                    files=files,
-                    data=data,
-                    timeout=30
+                    content=iter_lms_body(head, f, tail),
+                    headers={"Content-Type": content_type, "Content-Length": str(length)}
                 )
+            finally:
+                await run_in_threadpool(f.close)
 
             if response.status_code == 200:
                 log_event("callback_success", video_id=video_id)
@@ -208,7 +866,7 @@ def send_to_lms(video_id, organization_id, compressed_path):
             log_event("callback_error", level="error", video_id=video_id, error=str(e))
 
         if attempt < retries:
-            time.sleep(backoff)
+            await asyncio.sleep(backoff)
             backoff *= 2
 
     return False
@@ -218,77 +876,226 @@ def send_to_lms(video_id, organization_id, compressed_path):
 # BACKGROUND WORKER
 # ==========================================================
 
-def background_process_video(video_id, organization_id, input_path, output_path):
+# Caps concurrent ffmpeg processes separately from job workers, so one
+# job's LMS upload can proceed while another job holds the encoder.
+ffmpeg_slots = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+
+
+async def background_process_video(video_id, organization_id, input_path, output_path, preset, codec):
+    # JobManager calls are blocking Redis round trips; keep them off the loop
     try:
-        job_manager.update_status(video_id, "processing")
+        await run_in_threadpool(job_manager.update_status, video_id, "processing")
         log_event("compression_started", video_id=video_id)
 
-        start = time.time()
-        compress_video_ffmpeg(input_path, output_path)
-        duration = time.time() - start
+        async with ffmpeg_slots:
+            start = time.time()
+            await compress_video_ffmpeg(input_path, output_path, preset, codec)
+            duration = time.time() - start
 
         log_event("compression_completed", video_id=video_id, duration=duration)
 
-        success = send_to_lms(video_id, organization_id, output_path)
+        success = await send_to_lms(video_id, organization_id, output_path)
 
         if success:
-            job_manager.update_status(video_id, "awaiting_confirmation", {
+            await run_in_threadpool(job_manager.update_status, video_id, "awaiting_confirmation", {
                 "compressed_path": output_path
             })
         else:
-            job_manager.update_status(video_id, "failed")
+            await run_in_threadpool(job_manager.update_status, video_id, "failed")
 
     except Exception as e:
         log_event("compression_failed", level="error", video_id=video_id, error=str(e))
-        job_manager.update_status(video_id, "failed")
+        await run_in_threadpool(job_manager.update_status, video_id, "failed")
+
+
+# A fixed set of workers drains the queue, so a burst of uploads waits here
+# instead of spawning one ffmpeg per request. Workers are asyncio tasks:
+# while ffmpeg runs no thread is parked on it.
+job_queue: asyncio.Queue = asyncio.Queue()
+active_jobs = set()  # video_ids currently being processed
+
+
+async def job_worker():
+    while True:
+        job = await job_queue.get()
+        video_id = job[0]
+        active_jobs.add(video_id)
+        try:
+            await background_process_video(*job)
+        finally:
+            active_jobs.discard(video_id)
+            job_queue.task_done()
+
+
+def start_job_workers():
+    return [
+        asyncio.create_task(job_worker(), name=f"job-worker-{i}")
+        for i in range(MAX_CONCURRENT_JOBS)
+    ]
+
+
+async def stop_job_workers(workers):
+    # Queued and running jobs die with this instance; give them a terminal
+    # status now rather than leaving "processing" until the TTL expires.
+    unfinished = set(active_jobs)
+    while not job_queue.empty():
+        unfinished.add(job_queue.get_nowait()[0])
+
+    # Wait for the cancellations to land so in-flight ffmpeg runs are killed
+    # and no worker can pick up another job
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+    if unfinished:
+        try:
+            await run_in_threadpool(
+                job_manager.update_statuses_bulk,
+                {video_id: "failed" for video_id in unfinished}
+            )
+            log_event("unfinished_jobs_failed", count=len(unfinished))
+        except Exception as e:
+            # Best effort: the TTL still expires these jobs eventually
+            log_event("unfinished_jobs_update_failed", level="error", count=len(unfinished), error=str(e))
 
 
 # ==========================================================
-# ENDPOINTS
+# APP LIFESPAN
 # ==========================================================
 
-@app.get("/health")
-def health():
-    return {
-        "status": "ok",
-        "redis_enabled": job_manager.use_redis,
-        "host": socket.gethostname()
-    }
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Sweep on a timer instead of scanning VIDEO_DIR on every upload
+    orphan_cleanup_task = asyncio.create_task(periodic_orphan_cleanup())
+    job_workers = start_job_workers()
+
+    yield
+
+    # Order matters: workers may be mid-delivery, so stop them (and fail
+    # their jobs) before closing the LMS client they are using.
+    try:
+        await stop_job_workers(job_workers)
+    finally:
+        orphan_cleanup_task.cancel()
+        await lms_client.aclose()
+        await job_manager.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
-@app.post("/video/receive")
-async def receive_video(
-    background_tasks: BackgroundTasks,
-    video_id: str = Form(...),
-    organization_id: str = Form(...),
-    file: UploadFile = File(...),
-    x_internal_service_key: str = Header(None)
-):
-    if x_internal_service_key != INTERNAL_SERVICE_KEY:
+# ==========================================================
+# AUTH
+# ==========================================================
+
+SERVICE_KEY_BYTES = INTERNAL_SERVICE_KEY.encode()
+
+
+def require_service_key(x_internal_service_key: str = Header(None)):
+    # Constant-time compare; bytes so non-ASCII header values can't raise
+    provided = (x_internal_service_key or "").encode()
+    if not hmac.compare_digest(provided, SERVICE_KEY_BYTES):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    cleanup_orphan_files()
 
-    ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in ALLOWED_VIDEO_EXTENSIONS:
-        raise HTTPException(status_code=400, detail="Unsupported format")
+# ==========================================================
+# RESPONSE MODELS
+# ==========================================================
+
+# Declared as return types so FastAPI serializes straight to JSON bytes via
+# pydantic-core instead of going through jsonable_encoder + json.dumps.
+
+class HealthResponse(BaseModel):
+    status: str
+    redis_enabled: bool
+    host: str
+    queued_jobs: int
+    active_jobs: int
+
 
-    input_filename = f"{uuid.uuid4()}_raw{ext}"
-    output_filename = f"{uuid.uuid4()}_720p{ext}"
+class JobStatusResponse(BaseModel):
+    video_id: str
+    status: str
 
-    input_path = os.path.join(VIDEO_DIR, input_filename)
-    output_path = os.path.join(VIDEO_DIR, output_filename)
 
+# ==========================================================
+# ENDPOINTS
+# ==========================================================
+
+@app.get("/health")
+def health() -> HealthResponse:
+    return HealthResponse(
+        status="ok",
+        redis_enabled=job_manager.use_redis,
+        host=HOSTNAME,
+        queued_jobs=job_queue.qsize(),
+        active_jobs=len(active_jobs)
+    )
+
+
+@app.post("/video/receive", dependencies=[Depends(require_service_key)])
+async def receive_video(request: Request) -> JobStatusResponse:
+    # Reject from the header alone so an oversized upload writes nothing.
+    # The allowance covers the multipart framing and the text fields.
+    try:
+        content_length = int(request.headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+    if content_length > MAX_VIDEO_SIZE_BYTES + MAX_FORM_OVERHEAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large")
+
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data")
+
+    form = StreamingVideoForm(params[b"boundary"])
+    pending = bytearray()
     try:
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Parsing and disk writes run in the threadpool so concurrent uploads
+        # don't queue behind each other's I/O; body messages are batched to
+        # ~1 MiB to keep the number of thread hand-offs low.
+        async for chunk in request.stream():
+            pending += chunk
+            if len(pending) >= UPLOAD_CHUNK_SIZE:
+                batch, pending = pending, bytearray()
+                await run_in_threadpool(form.write, batch)
+        await run_in_threadpool(form.write, pending)
+        await run_in_threadpool(form.finalize)
+    except HTTPException:
+        form.discard()
+        raise
+    except MultipartParseError:
+        form.discard()
+        raise HTTPException(status_code=400, detail="Malformed multipart body")
     except Exception as e:
+        form.discard()
         raise HTTPException(status_code=500, detail=str(e))
 
-    file_size_mb = os.path.getsize(input_path) / (1024 * 1024)
-    if file_size_mb > MAX_VIDEO_SIZE_MB:
-        os.remove(input_path)
-        raise HTTPException(status_code=400, detail="File too large")
+    video_id = form.fields.get("video_id")
+    organization_id = form.fields.get("organization_id")
+    preset = form.fields.get("preset", DEFAULT_X264_PRESET)
+    codec = form.fields.get("codec", "h264")
+
+    error = None
+    if form.input_path is None:
+        error = (422, "Missing file")
+    elif video_id is None or organization_id is None:
+        error = (422, "video_id and organization_id are required")
+    elif preset not in ALLOWED_X264_PRESETS:
+        error = (400, "Unsupported preset")
+    elif codec not in SOFTWARE_ENCODERS:
+        error = (400, "Unsupported codec")
+
+    if error:
+        form.discard()
+        raise HTTPException(status_code=error[0], detail=error[1])
+
+    # The upload is kept on disk rather than piped into ffmpeg's stdin: the
+    # job may wait in job_queue, the probe and any hardware-encode fallback
+    # each re-read the input, and MP4/MOV files with a trailing moov atom
+    # can't be demuxed from a pipe.
+    input_path = form.input_path
+    output_path = f"{VIDEO_DIR}/{form.uid}_720p{form.ext}"
 
     job_data = {
         "status": "queued",
@@ -296,61 +1103,75 @@ async def receive_video(
         "compressed_path": "",
         "created_at": time.time(),
         "video_id": video_id,
-        "org_id": organization_id
+        "org_id": organization_id,
+        "preset": preset,
+        "codec": codec
     }
 
-    job_manager.set_job(video_id, job_data)
+    await run_in_threadpool(job_manager.set_job, video_id, job_data)
 
-    background_tasks.add_task(
-        background_process_video,
+    await job_queue.put((
         video_id,
         organization_id,
         input_path,
-        output_path
-    )
+        output_path,
+        preset,
+        codec
+    ))
 
-    return {"status": "queued", "video_id": video_id}
+    return JobStatusResponse(status="queued", video_id=video_id)
 
 
-@app.post("/video/confirm")
-def confirm_video(
-    video_id: str = Form(...),
-    x_internal_service_key: str = Header(None)
-):
-    if x_internal_service_key != INTERNAL_SERVICE_KEY:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-
-    job = job_manager.get_job(video_id)
+@app.post("/video/confirm", dependencies=[Depends(require_service_key)])
+async def confirm_video(video_id: str = Form(...)) -> JobStatusResponse:
+    # Check-and-set in one atomic step so concurrent confirms (or a racing
+    # worker update) can't both pass the status check
+    job = await run_in_threadpool(
+        job_manager.transition_status, video_id, "awaiting_confirmation", "completed"
+    )
     if not job:
         raise HTTPException(status_code=404, detail="Not found")
 
     if job["status"] == "completed":
-        return {"status": "completed", "video_id": video_id}
+        return JobStatusResponse(status="completed", video_id=video_id)
 
     if job["status"] != "awaiting_confirmation":
         raise HTTPException(status_code=400, detail="Not ready")
 
-    # Delete files
-    try:
-        if os.path.exists(job["file_path"]):
-            os.remove(job["file_path"])
-        if os.path.exists(job["compressed_path"]):
-            os.remove(job["compressed_path"])
-    except Exception:
-        pass
+    # This request won the transition: delete both files concurrently, off
+    # the event loop. Failures are ignored; the orphan sweep retries them.
+    await asyncio.gather(
+        run_in_threadpool(_unlink_silent, job["file_path"]),
+        run_in_threadpool(_unlink_silent, job["compressed_path"]),
+        return_exceptions=True
+    )
 
-    job_manager.update_status(video_id, "completed")
+    return JobStatusResponse(status="completed", video_id=video_id)
 
-    return {"status": "completed", "video_id": video_id}
 
+@app.get("/video/status/{video_id}", dependencies=[Depends(require_service_key)])
+def status(video_id: str) -> JobStatusResponse:
+    job = job_manager.get_job(video_id)
+    return JobStatusResponse(
+        video_id=video_id,
+        status=job["status"] if job else "not_found"
+    )
 
-@app.get("/video/status/{video_id}")
-def status(video_id: str, x_internal_service_key: str = Header(None)):
-    if x_internal_service_key != INTERNAL_SERVICE_KEY:
-        raise HTTPException(status_code=401, detail="Unauthorized")
 
-    job = job_manager.get_job(video_id)
-    return {
-        "video_id": video_id,
-        "status": job["status"] if job else "not_found"
-    }
+@app.get("/video/status/{video_id}/wait", dependencies=[Depends(require_service_key)])
+async def wait_for_status(
+    video_id: str,
+    since: Optional[str] = None,
+    timeout: float = Query(30, ge=0, le=MAX_STATUS_WAIT_SECONDS)
+) -> JobStatusResponse:
+    if since is None:
+        job = await job_manager.get_job_async(video_id)
+        if not job:
+            return JobStatusResponse(video_id=video_id, status="not_found")
+        since = job["status"]
+
+    status = await job_manager.wait_for_status_change(video_id, since, timeout)
+    return JobStatusResponse(
+        video_id=video_id,
+        status=status or "not_found"
+    )
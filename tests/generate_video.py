@@ -1,6 +1,25 @@
 import subprocess
 import os
 
+
+def pick_encoder():
+    # Use NVENC when the GPU is really there; distro ffmpeg builds list it
+    # regardless, so confirm with a one-frame test encode.
+    probe = subprocess.run(
+        [
+            "ffmpeg", "-hide_banner", "-v", "error",
+            "-f", "lavfi", "-i", "color=black:s=256x256:d=0.1",
+            "-frames:v", "1",
+            "-c:v", "h264_nvenc",
+            "-f", "null", "-"
+        ],
+        capture_output=True
+    )
+    if probe.returncode == 0:
+        return ["-c:v", "h264_nvenc", "-preset", "p4"]
+    return ["-c:v", "libx264", "-preset", "veryfast"]
+
+
 def generate_video(filename="test_video_1080p.mp4"):
     # Generate 5 seconds of 1080p video
     command = [
@@ -8,7 +27,7 @@ def generate_video(filename="test_video_1080p.mp4"):
         "-y",
         "-f", "lavfi",
         "-i", "testsrc=duration=5:size=1920x1080:rate=30",
-        "-c:v", "libx264",
+        *pick_encoder(),
         "-pix_fmt", "yuv420p",
         filename
     ]
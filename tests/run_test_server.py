@@ -7,31 +7,75 @@ sys.path.append(os.getcwd())
 
 from app import app
 import app as app_module
-from unittest.mock import MagicMock
-import time
-import requests
-
-# Mock SFTP to avoid failure and simulate success
-# We also add a small delay to simulate network latency if needed.
-def mock_upload(local, remote):
-    if os.path.exists(local):
-        size = os.path.getsize(local)
+import struct
+
+def _iter_boxes(data, start, end):
+    # Yields (type, payload_start, box_end) for each ISO-BMFF box in data[start:end]
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack(">I4s", data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def mp4_video_height(path):
+    # Read the height straight from moov/trak/tkhd instead of forking ffprobe
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            size, box_type = struct.unpack(">I4s", header)
+            header_len = 8
+            if size == 1:
+                size = struct.unpack(">Q", f.read(8))[0]
+                header_len = 16
+            if box_type == b"moov":
+                moov = f.read(size - header_len) if size else f.read()
+                break
+            if size == 0:
+                return None
+            f.seek(size - header_len, os.SEEK_CUR)
+
+    for box_type, start, end in _iter_boxes(moov, 0, len(moov)):
+        if box_type != b"trak":
+            continue
+        for child, child_start, child_end in _iter_boxes(moov, start, end):
+            if child == b"tkhd":
+                # tkhd ends with width and height as 16.16 fixed point;
+                # audio tracks report 0
+                height = struct.unpack(">I", moov[child_end - 4:child_end])[0] >> 16
+                if height:
+                    return height
+    return None
+
+
+# Report output metrics just before each LMS delivery. Workers look up
+# send_to_lms at call time, so wrapping the module attribute takes effect.
+original_send_to_lms = app_module.send_to_lms
+
+async def metered_send_to_lms(video_id, organization_id, compressed_path):
+    if os.path.exists(compressed_path):
+        size = os.path.getsize(compressed_path)
         print(f"[METRICS] Compressed size: {size} bytes")
-        
+
         # Get resolution
         try:
-            probe = subprocess.run(
-                ["ffprobe", "-v", "error", "-select_streams", "v:0", 
-                 "-show_entries", "stream=height", "-of", "csv=s=x:p=0", local],
-                capture_output=True, text=True
-            )
-            height = probe.stdout.strip()
+            height = mp4_video_height(compressed_path)
             print(f"[METRICS] Compressed height: {height}")
         except Exception as e:
             print(f"[METRICS] Error probing resolution: {e}")
-    time.sleep(2) # Simulate upload time
+    return await original_send_to_lms(video_id, organization_id, compressed_path)
 
-app_module.upload_to_sftp = mock_upload
+app_module.send_to_lms = metered_send_to_lms
 
 # Mock remove to verify cleanup calls
 original_remove = os.remove
@@ -41,21 +85,6 @@ def mock_remove(path):
 
 app_module.os.remove = mock_remove
 
-# Mock requests.post for confirmation call
-app_module.CLIENT_CONFIRM_API = "http://mock-confirm"
-original_post = requests.post
-
-def mock_post(url, *args, **kwargs):
-    print(f"[MOCK_POST] Calling {url}")
-    if url == app_module.CLIENT_CONFIRM_API:
-        print("[MOCK_POST] Simulating 200 OK for confirmation")
-        mock_resp = MagicMock()
-        mock_resp.status_code = 200
-        return mock_resp
-    return original_post(url, *args, **kwargs)
-
-app_module.requests.post = mock_post
-
 if __name__ == "__main__":
     # Run on a different port to avoid conflicts
     uvicorn.run(app, host="127.0.0.1", port=8001)
@@ -103,6 +103,26 @@ def run_test():
         assert resp.status_code == 200
         print("✔ Video accepted")
 
+        # 4b. Long-poll until the job leaves 'queued'
+        print("\n--- STEP 1b: Long-Poll for Status Change ---")
+        wait_resp = requests.get(
+            f"{SERVICE_URL}/video/status/{VIDEO_ID}/wait",
+            params={"since": "queued", "timeout": 30},
+            headers={"X-Internal-Service-Key": TEST_KEY}
+        )
+        print(f"Wait Resp: {wait_resp.json()}")
+        assert wait_resp.status_code == 200
+        assert wait_resp.json()["status"] != "queued"
+        print("✔ Long-poll returned on status change")
+
+        bad_wait = requests.get(
+            f"{SERVICE_URL}/video/status/{VIDEO_ID}/wait",
+            params={"timeout": "nan"},
+            headers={"X-Internal-Service-Key": TEST_KEY}
+        )
+        print(f"Wait with timeout=nan: {bad_wait.status_code}")
+        assert bad_wait.status_code == 422
+
         # 5. Wait for Callback (Step 2)
         print("\n--- Waiting for Callback (Processing) ---")
         max_wait = 15
@@ -150,6 +170,26 @@ def run_test():
         print(f"Final Status: {status}")
         assert status == "completed"
 
+        # 6b. A repeated confirm is idempotent, not an error
+        print("\n--- STEP 3b: Repeating Confirmation ---")
+        second_confirm = requests.post(
+            f"{SERVICE_URL}/video/confirm",
+            data={"video_id": VIDEO_ID},
+            headers={"X-Internal-Service-Key": TEST_KEY}
+        )
+        print(f"Second Confirm Resp: {second_confirm.status_code} {second_confirm.json()}")
+        assert second_confirm.status_code == 200
+        assert second_confirm.json()["status"] == "completed"
+        print("✔ Double confirm accepted once")
+
+        unknown_confirm = requests.post(
+            f"{SERVICE_URL}/video/confirm",
+            data={"video_id": "no_such_video"},
+            headers={"X-Internal-Service-Key": TEST_KEY}
+        )
+        print(f"Unknown Confirm Resp: {unknown_confirm.status_code}")
+        assert unknown_confirm.status_code == 404
+
         # 7. Check Cleanup (Check logs or existence? Server is in another process, hard to verify files directly 
         # unless checking the dir properly). Since we are running locally, we can check the dir.
         print("\n--- Verifying Cleanup ---")
@@ -0,0 +1,128 @@
+
+import requests
+import subprocess
+import time
+import os
+import sys
+import http.client
+
+# ---------------- CONFIG ----------------
+SERVICE_PORT = 8001
+SERVICE_HOST = "127.0.0.1"
+SERVICE_URL = f"http://{SERVICE_HOST}:{SERVICE_PORT}"
+
+TEST_KEY = "k2Ref6wLwalxzVYtJbt1QRukKk9fb_qczS5AkatD8js"
+HEADERS = {"X-Internal-Service-Key": TEST_KEY}
+VIDEO_ID = "test_vid_validation"
+ORG_ID = "org_001"
+
+MAX_VIDEO_SIZE_BYTES = 500 * 1024 * 1024
+
+
+def raw_files_in_temp_dir():
+    if not os.path.isdir("temp_videos"):
+        return []
+    return [f for f in os.listdir("temp_videos") if "_raw" in f]
+
+# ---------------- TEST LOGIC ----------------
+
+def run_test():
+    # 1. Start Compression Service Process. Nothing here reaches the LMS.
+    print("--- Starting Compression Service ---")
+    env = os.environ.copy()
+    env["LMS_STORE_URL"] = "http://127.0.0.1:1/video/store"
+    env["INTERNAL_SERVICE_KEY"] = TEST_KEY
+
+    server_process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", SERVICE_HOST, "--port", str(SERVICE_PORT)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        bufsize=1,
+        universal_newlines=True,
+        env=env
+    )
+
+    time.sleep(3) # Wait for startup
+
+    try:
+        raw_before = set(raw_files_in_temp_dir())
+
+        # STEP 1: Unsupported extension
+        print("\n--- STEP 1: Unsupported Extension ---")
+        resp = requests.post(
+            f"{SERVICE_URL}/video/receive",
+            files={"file": ("notes.txt", b"not a video")},
+            data={"video_id": VIDEO_ID, "organization_id": ORG_ID},
+            headers=HEADERS
+        )
+        print(f"Receive Status: {resp.status_code} {resp.json()}")
+        assert resp.status_code == 400
+        assert resp.json()["detail"] == "Unsupported format"
+        print("✔ Unsupported extension rejected")
+
+        # STEP 2: Oversized upload, rejected from Content-Length alone
+        print("\n--- STEP 2: Oversized Upload ---")
+        conn = http.client.HTTPConnection(SERVICE_HOST, SERVICE_PORT, timeout=10)
+        conn.putrequest("POST", "/video/receive")
+        conn.putheader("X-Internal-Service-Key", TEST_KEY)
+        conn.putheader("Content-Type", "multipart/form-data; boundary=B")
+        conn.putheader("Content-Length", str(MAX_VIDEO_SIZE_BYTES * 2))
+        conn.endheaders()
+        oversized = conn.getresponse()
+        print(f"Receive Status: {oversized.status}")
+        assert oversized.status == 413
+        conn.close()
+        print("✔ Oversized upload rejected with 413")
+
+        # STEP 3: Missing organization_id
+        print("\n--- STEP 3: Missing Field ---")
+        resp = requests.post(
+            f"{SERVICE_URL}/video/receive",
+            files={"file": ("clip.mp4", b"\x00" * 1024)},
+            data={"video_id": VIDEO_ID},
+            headers=HEADERS
+        )
+        print(f"Receive Status: {resp.status_code} {resp.json()}")
+        assert resp.status_code == 422
+        print("✔ Missing field rejected with 422")
+
+        # STEP 4: Body cut off before the closing boundary
+        print("\n--- STEP 4: Truncated Upload ---")
+        body = (
+            b'--B\r\nContent-Disposition: form-data; name="video_id"\r\n\r\n' + VIDEO_ID.encode() + b'\r\n'
+            b'--B\r\nContent-Disposition: form-data; name="organization_id"\r\n\r\n' + ORG_ID.encode() + b'\r\n'
+            b'--B\r\nContent-Disposition: form-data; name="file"; filename="clip.mp4"\r\n\r\n'
+            + b"\x00" * 4096
+        )
+        resp = requests.post(
+            f"{SERVICE_URL}/video/receive",
+            data=body,
+            headers={**HEADERS, "Content-Type": "multipart/form-data; boundary=B"}
+        )
+        print(f"Receive Status: {resp.status_code} {resp.json()}")
+        assert resp.status_code == 400
+
+        status_resp = requests.get(f"{SERVICE_URL}/video/status/{VIDEO_ID}", headers=HEADERS)
+        assert status_resp.json()["status"] == "not_found"
+        print("✔ Truncated upload rejected and no job created")
+
+        # Rejected uploads must not leave anything behind
+        leftover = set(raw_files_in_temp_dir()) - raw_before
+        print(f"New raw files in temp_videos: {sorted(leftover)}")
+        assert not leftover
+        print("✔ No partial uploads left in temp_videos")
+
+    except Exception as e:
+        print(f"FAILED: {e}")
+    finally:
+        print("Stopping service...")
+        server_process.terminate()
+        outs, errs = server_process.communicate()
+        print("\n--- SERVER LOGS (STDOUT) ---")
+        print(outs)
+        print("\n--- SERVER LOGS (STDERR) ---")
+        print(errs)
+
+if __name__ == "__main__":
+    run_test()